@@ -1,11 +1,59 @@
 import os
 import re
 import json
-import html
+import bisect
+import pathlib
+import itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
+try:
+    # orjson is much faster on large Tsakorpus JSON files, but optional
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+try:
+    # With ijson, Tsakorpus JSON files can be read sentence by sentence
+    # instead of being loaded into memory as a whole (see streamJson)
+    import ijson
+except ImportError:
+    ijson = None
 
 
 EAF_TIME_MULTIPLIER = 1000  # time stamps are in milliseconds
+rxTierCache = {}            # tier name regex string -> compiled regex
+
+
+def compile_tier_regex(tiers):
+    """
+    Anchor a regex for tier names or types at both ends, compile it
+    and return the compiled regex. Compiled regexes are cached, so that
+    processors created for each file do not compile them again.
+    """
+    if tiers not in rxTierCache:
+        rxTiers = tiers
+        if not rxTiers.startswith('^'):
+            rxTiers = '^' + rxTiers
+        if not rxTiers.endswith('$'):
+            rxTiers += '$'
+        rxTierCache[tiers] = re.compile(rxTiers)
+    return rxTierCache[tiers]
+
+
+class AnalyzedSegment:
+    """
+    One time-aligned segment of a Tsakorpus sentence together
+    with its analyzed words. Corpora contain a lot of segments,
+    hence slots instead of a dictionary.
+    """
+    __slots__ = ('startTime', 'words', 'text', 'textNorm')
+
+    def __init__(self, startTime, text):
+        self.startTime = startTime
+        self.words = []
+        self.text = text
+        self.textNorm = ''      # stripped lowercase text, filled in by clean_segments
 
 
 class EafProcessor:
@@ -13,8 +61,13 @@ class EafProcessor:
     Contains methods for adding morphological analysis from a Tsakorpus
     JSON file to the source ELAN file.
     """
-    rxDir = re.compile('[/\\\\][^/\\\\]+$')
     rxSpeakerCode = re.compile('^\\[[^\\[\\]]+\\]$')
+    # XPath expressions are compiled once per process rather than
+    # for every processor, since process_one creates one per file
+    xpTiers = etree.XPath('/ANNOTATION_DOCUMENT/TIER')
+    # Relative to ANNOTATION_DOCUMENT
+    xpChildTier = etree.XPath('TIER[@LINGUISTIC_TYPE_REF=$tierType and @PARENT_REF=$parentID]')
+    xpTierType = etree.XPath('/ANNOTATION_DOCUMENT/LINGUISTIC_TYPE[@LINGUISTIC_TYPE_ID=$tierType]')
 
     def __init__(self, tiers, lang='',
                  wordType='words', lemmaType='lemma',
@@ -23,9 +76,17 @@ class EafProcessor:
                  lexTiers=None,
                  grammTiers=None,
                  csTier=None,
-                 csTurnOffRegex=''):
+                 csTurnOffRegex='',
+                 streamJson=False,
+                 settings=None):
         self.eafTree = None
-        self.jsonDoc = None
+        self.jsonSentences = None   # iterable of Tsakorpus JSON sentences
+        # Read JSON files incrementally with ijson: slower than loading
+        # them as a whole, but uses much less memory on large files
+        self.streamJson = streamJson
+        if self.streamJson and ijson is None:
+            print('ijson not found; JSON files will be loaded as a whole.')
+            self.streamJson = False
         self.lang = lang
         self.wordType = wordType
         self.lemmaType = lemmaType
@@ -38,6 +99,10 @@ class EafProcessor:
         self.addGrammTiers = []    # Additional tiers, children of gramm tier
         if grammTiers is not None:
             self.addGrammTiers = grammTiers
+        # Additional tiers are inserted after their parent one by one,
+        # so they are created in reverse order
+        self.addLexTiersSorted = sorted(self.addLexTiers, reverse=True)
+        self.addGrammTiersSorted = sorted(self.addGrammTiers, reverse=True)
         self.csTier = ''            # Tier where code switching is annotated
                                     # (must be associated with the transcription)
         self.rxCSTier = ''
@@ -46,19 +111,29 @@ class EafProcessor:
             self.csTurnOffRegex = re.compile(csTurnOffRegex)
             # Do not annotate transcription segments
             # if the associated CS segment matches this regex
-            if not self.csTier.startswith('^'):
-                self.csTier = '^' + self.csTier
-            if not self.csTier.endswith('$'):
-                self.csTier += '$'
-            self.rxCSTier = re.compile(self.csTier)
+            self.rxCSTier = compile_tier_regex(self.csTier)
         self.csTranscriptionSegments = []
-        if not tiers.startswith('^'):
-            tiers = '^' + tiers
-        if not tiers.endswith('$'):
-            tiers += '$'
-        self.rxTiers = re.compile(tiers)    # regex for names or types of tiers to be analyzed
+        self.tiers = tiers
+        self.rxTiers = compile_tier_regex(tiers)    # regex for names or types of tiers to be analyzed
         self.lastID = 0
-        self.settings = self.load_settings()
+        self.lastIDProp = None      # lastUsedAnnotationId header property
+        # Settings are read only once; processors created in
+        # worker processes get them from the parent (see get_worker_args)
+        self.settings = settings
+        if self.settings is None:
+            self.settings = self.load_settings()
+        # Grammatical field -> its position in gr_fields_order, or None
+        # if the order is not defined for this language
+        self.grFieldsOrder = None
+        self.nGrFields = 0
+        if ('lang_props' in self.settings
+                and self.lang in self.settings['lang_props']
+                and 'gr_fields_order' in self.settings['lang_props'][self.lang]):
+            self.grFieldsOrder = {}
+            for i, field in enumerate(self.settings['lang_props'][self.lang]['gr_fields_order']):
+                self.grFieldsOrder.setdefault(field, i)
+            self.nGrFields = len(self.settings['lang_props'][self.lang]['gr_fields_order'])
+        self.join_gramm_cached = functools.lru_cache(maxsize=65536)(self.join_gramm)
 
     def load_settings(self):
         """
@@ -70,26 +145,23 @@ class EafProcessor:
             print('conf/corpus.json not found; grammatical tags ordeing can be chaotic.')
             return {}
         settings = {}
-        with open(fnameIn, 'r', encoding='utf-8') as fIn:
-            settings = json.load(fIn)
+        with open(fnameIn, 'rb') as fIn:
+            settings = json_loads(fIn.read())
         return settings
 
     def get_tlis(self, srcTree):
         """
-        Retrieve and return all time labels from the XML tree.
-        """
-        tlis = {}
-        iTli = 0
-        for tli in srcTree.xpath('/ANNOTATION_DOCUMENT/TIME_ORDER/TIME_SLOT'):
-            timeValue = ''
-            if 'TIME_VALUE' in tli.attrib:
-                timeValue = tli.attrib['TIME_VALUE']
-            tlis[tli.attrib['TIME_SLOT_ID']] = {
-                'n': iTli,
-                'time': float(timeValue) / EAF_TIME_MULTIPLIER
-            }
-            iTli += 1
-        return tlis
+        Retrieve all time labels from the XML tree and return
+        a dictionary {time slot ID -> time in seconds}.
+        """
+        tlisTime = {}
+        if hasattr(srcTree, 'getroot'):
+            srcTree = srcTree.getroot()
+        for tli in srcTree.iter('TIME_SLOT'):
+            # Unaligned time slots have no value
+            timeValue = tli.get('TIME_VALUE', '0')
+            tlisTime[tli.get('TIME_SLOT_ID')] = float(timeValue) / EAF_TIME_MULTIPLIER
+        return tlisTime
 
     def write_analyses(self, fnameEafOut):
         """
@@ -97,11 +169,19 @@ class EafProcessor:
         """
         if self.eafTree is None:
             return
-        with open(fnameEafOut, 'w', encoding='utf-8', newline='\n') as fOut:
-            fOut.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-            text = str(etree.tostring(self.eafTree, pretty_print=True, encoding='unicode'))
-            text = text.replace('</TIER><TIER', '</TIER>\n\t<TIER')
-            fOut.write(text)
+        # The tree is serialized directly into the file, without
+        # building the whole document as a string first.
+        self.eafTree.write(fnameEafOut, pretty_print=True,
+                           xml_declaration=True, encoding='UTF-8')
+
+    def insert_after(self, node, newNode):
+        """
+        Insert newNode as the next sibling of node. The new node
+        gets the same trailing whitespace as node, so that newly
+        added tiers start on a new line in the output.
+        """
+        newNode.tail = node.tail
+        node.addnext(newNode)
 
     def clean_segments(self, segments):
         """
@@ -110,47 +190,72 @@ class EafProcessor:
         automatically during ELAN -> JSON conversion.
         """
         for s in segments:
-            if len(s['words']) <= 0:
-                continue
-            s['text'] = s['text'].strip()
-            while len(s['words']) > 0 and len(s['words'][0]['wf'].strip()) <= 0:
-                del s['words'][0]
-            if len(s['words']) <= 0:
-                continue
-            firstWord = s['words'][0]
-            if (firstWord['wtype'] != 'word'
-                    and EafProcessor.rxSpeakerCode.search(firstWord['wf']) is not None
-                    and s['text'].startswith(firstWord['wf'])):
-                s['text'] = s['text'][len(firstWord['wf']):].strip()
-                del s['words'][0]
-
-    def collect_analyzed_segments(self):
+            s.text = s.text.strip()
+            iFirstWord = 0
+            while iFirstWord < len(s.words) and len(s.words[iFirstWord]['wf'].strip()) <= 0:
+                iFirstWord += 1
+            if iFirstWord < len(s.words):
+                firstWf = s.words[iFirstWord]['wf']
+                # Cheap string checks first: most segments do not
+                # start with a speaker code
+                if (s.words[iFirstWord]['wtype'] != 'word'
+                        and firstWf.startswith('[') and firstWf.endswith(']')
+                        and EafProcessor.rxSpeakerCode.search(firstWf) is not None
+                        and s.text.startswith(firstWf)):
+                    s.text = s.text[len(firstWf):].strip()
+                    iFirstWord += 1
+            if iFirstWord > 0:
+                s.words = s.words[iFirstWord:]
+            # Transcription segments are matched against normalized text
+            s.textNorm = s.text.lower()
+
+    def iter_json_sentences(self, fnameJson):
+        """
+        Iterate over the sentences of a Tsakorpus JSON file. If
+        streamJson is on, the file is parsed incrementally with ijson.
         """
-        Collect all time-aligned segments from the JSON object. For
-        each segment, store the analyses of its words in a dictionary.
+        with open(fnameJson, 'rb') as fJson:
+            if self.streamJson:
+                yield from ijson.items(fJson, 'sentences.item', use_float=True)
+                return
+            jsonDoc = json_loads(fJson.read())
+            if 'sentences' in jsonDoc:
+                yield from jsonDoc['sentences']
+
+    def collect_analyzed_segments(self, sentences):
+        """
+        Collect all time-aligned segments from an iterable of JSON
+        sentences. For each segment, store the analyses of its words.
+        Only the segments are kept, not the sentences themselves.
         """
         analyzedSegments = []
-        # Sentences are sorted by their start time.
-        for s in self.jsonDoc['sentences']:
-            if 'lang' not in s or s['lang'] != 0:
+        for s in sentences:
+            if s.get('lang') != 0:
                 continue
             if 'src_alignment' not in s or 'words' not in s:
                 continue
+            # Words are sorted by their offsets, so the words of each
+            # aligned segment can be found by binary search. They
+            # normally come in this order already, in which case
+            # the (stable) sort takes linear time.
+            words = sorted(s['words'], key=lambda word: word['off_start'])
+            starts = [word['off_start'] for word in words]
+            ends = [word['off_end'] for word in words]
             for sa in s['src_alignment']:
                 offStart = sa['off_start_sent']
                 offEnd = sa['off_end_sent']
-                curSegment = {
-                    'start_time': sa['true_off_start_src'],
-                    'words': [],
-                    'text': s['text'][offStart:offEnd]
-                }
-                for word in s['words']:
-                    wOffStart = word['off_start']
-                    wOffEnd = word['off_end']
-                    if wOffStart >= offStart and wOffEnd <= offEnd:
-                        curSegment['words'].append(word)
-                if len(curSegment['words']) > 0:
+                curSegment = AnalyzedSegment(sa['true_off_start_src'],
+                                             s['text'][offStart:offEnd])
+                iWord = bisect.bisect_left(starts, offStart)
+                while iWord < len(words) and starts[iWord] <= offEnd:
+                    if ends[iWord] <= offEnd:
+                        curSegment.words.append(words[iWord])
+                    iWord += 1
+                if len(curSegment.words) > 0:
                     analyzedSegments.append(curSegment)
+        # Sentences should already be sorted by their start time,
+        # so this is cheap.
+        analyzedSegments.sort(key=lambda seg: seg.startTime)
         self.clean_segments(analyzedSegments)
         return analyzedSegments
 
@@ -158,15 +263,13 @@ class EafProcessor:
         """
         Create an XML element representing one annotation in analysis tiers.
         """
-        if prevID == '':
-            annoTxt = '<ANNOTATION>\n\t\t\t<REF_ANNOTATION ANNOTATION_ID="' + curID \
-                      + '" ANNOTATION_REF="' + parentID + '">\n'
-        else:
-            annoTxt = '<ANNOTATION>\n\t\t\t<REF_ANNOTATION ANNOTATION_ID="' + curID \
-                      + '" ANNOTATION_REF="' + parentID + '" PREVIOUS_ANNOTATION="' + prevID + '">\n'
-        annoTxt += '\t\t\t\t<ANNOTATION_VALUE>' + html.escape(text) \
-                   + '</ANNOTATION_VALUE>\n\t\t\t</REF_ANNOTATION>\n\t\t</ANNOTATION>'
-        return etree.XML(annoTxt)
+        annoEl = etree.Element('ANNOTATION')
+        refEl = etree.SubElement(annoEl, 'REF_ANNOTATION',
+                                 ANNOTATION_ID=curID, ANNOTATION_REF=parentID)
+        if len(prevID) > 0:
+            refEl.set('PREVIOUS_ANNOTATION', prevID)
+        etree.SubElement(refEl, 'ANNOTATION_VALUE').text = text
+        return annoEl
 
     def group_ana(self, word):
         """
@@ -190,22 +293,36 @@ class EafProcessor:
                 usedAna.add(anaStr)
         return anaByLemma
 
-    def parse_ana(self, ana):
+    def join_gramm(self, grValues):
         """
-        Retrieve grammatical tags and glosses from a JSON analysis.
+        Join the values of grammatical fields into one string, ordered
+        according to gr_fields_order. grValues is a frozenset of (field,
+        value) pairs, with list values converted to tuples, so that
+        the results can be cached. Fields of equal rank are ordered
+        by name.
         """
         def key_comp(p):
-            if ('lang_props' not in self.settings
-                    or self.lang not in self.settings['lang_props']
-                    or 'gr_fields_order' not in self.settings['lang_props'][self.lang]):
-                return -1
-            if p[0] not in self.settings['lang_props'][self.lang]['gr_fields_order']:
+            if self.grFieldsOrder is None:
+                return -1, p[0]
+            if p[0] not in self.grFieldsOrder:
                 if p[0].lower() == 'pos':
-                    return -2
-                return len(self.settings['lang_props'][self.lang]['gr_fields_order'])
-            return self.settings['lang_props'][self.lang]['gr_fields_order'].index(p[0])
+                    return -2, p[0]
+                return self.nGrFields, p[0]
+            return self.grFieldsOrder[p[0]], p[0]
 
         gramm = ''
+        for field, value in sorted(grValues, key=key_comp):
+            if type(value) == tuple:
+                value = ', '.join(value)
+            if len(gramm) > 0:
+                gramm += ', '
+            gramm += value
+        return gramm
+
+    def parse_ana(self, ana):
+        """
+        Retrieve grammatical tags and glosses from a JSON analysis.
+        """
         parts = ''
         if 'parts' in ana:
             parts = ana['parts']
@@ -213,34 +330,38 @@ class EafProcessor:
         if 'gloss' in ana:
             gloss = ana['gloss']
         grValues = []
-        for field in sorted(ana):
+        for field, value in ana.items():
             if not field.startswith('gr.'):
                 continue
-            value = ana[field]
             if type(value) == list:
-                value = ', '.join(value)
+                value = tuple(value)
             grValues.append((field[3:], value))
-        for fv in sorted(grValues, key=key_comp):
-            if len(gramm) > 0:
-                gramm += ', '
-            gramm += fv[1]
+        # The same sets of tags recur very often, so the joined
+        # strings are cached
+        gramm = self.join_gramm_cached(frozenset(grValues))
         return gramm, parts, gloss
 
-    def process_segment(self, segID, words, wordTier, lemmaTier, grammTier,
-                        partsTier, glossTier, addLexTiers, addGrammTiers):
+    def process_segment(self, segID, words, wordEls, lemmaEls, grammEls,
+                        partsEls, glossEls, addLexEls, addGrammEls):
         """
-        Add analyses for one segment.
+        Add analyses for one segment. New annotations are appended
+        to the lists of elements for each analysis tier (addLexEls
+        and addGrammEls are dictionaries {tier type -> list}) rather
+        than to the tiers themselves.
         """
         nTokens = 0
         nWords = 0
         nAnalyzed = 0
         prevWordID = ''
+        # The annotation counter is kept in a local variable
+        # while the segment is processed
+        lastID = self.lastID
         for word in words:
-            curWordID = 'a' + str(self.lastID)
-            self.lastID += 1
+            curWordID = 'a' + str(lastID)
+            lastID += 1
             wordEl = self.create_dependent_annotation(curWordID, segID, prevWordID, word['wf'])
             prevWordID = curWordID
-            wordTier.insert(-1, wordEl)
+            wordEls.append(wordEl)
             if segID in self.csTranscriptionSegments:
                 # Do not annotate code switches
                 continue
@@ -253,90 +374,134 @@ class EafProcessor:
                 nAnalyzed += 1
             prevLemmaID = ''
             for lemma in sorted(anaByLemma):
-                curLemmaID = 'a' + str(self.lastID)
-                self.lastID += 1
+                curLemmaID = 'a' + str(lastID)
+                lastID += 1
                 lemmaEl = self.create_dependent_annotation(curLemmaID, curWordID, prevLemmaID, lemma)
                 prevLemmaID = curLemmaID
-                lemmaTier.insert(-1, lemmaEl)
+                lemmaEls.append(lemmaEl)
                 prevGrammID = ''
-                for addLexTier in addLexTiers:
+                lemmaAnalyses = anaByLemma[lemma]
+                for addLexTier, addLexTierEls in addLexEls.items():
                     # It is assumed that the value of addLexTier is the same
                     # for all analyses with the given lemma
-                    if addLexTier in anaByLemma[lemma][0]:
-                        curAddID = 'a' + str(self.lastID)
-                        self.lastID += 1
-                        value = anaByLemma[lemma][0][addLexTier]
+                    if addLexTier in lemmaAnalyses[0]:
+                        curAddID = 'a' + str(lastID)
+                        lastID += 1
+                        value = lemmaAnalyses[0][addLexTier]
                         if type(value) == list:
                             value = '/'.join(value)
                         addEl = self.create_dependent_annotation(curAddID, curLemmaID, '', value)
-                        addLexTiers[addLexTier].insert(-1, addEl)
-                for ana in anaByLemma[lemma]:
-                    curGrammID = 'a' + str(self.lastID)
-                    self.lastID += 1
-                    curPartsID = 'a' + str(self.lastID)
-                    self.lastID += 1
-                    curGlossID = 'a' + str(self.lastID)
-                    self.lastID += 1
+                        addLexTierEls.append(addEl)
+                for ana in lemmaAnalyses:
+                    curGrammID = 'a' + str(lastID)
+                    lastID += 1
+                    curPartsID = 'a' + str(lastID)
+                    lastID += 1
+                    curGlossID = 'a' + str(lastID)
+                    lastID += 1
                     gramm, parts, gloss = self.parse_ana(ana)
                     grammEl = self.create_dependent_annotation(curGrammID, curLemmaID, prevGrammID, gramm)
                     partsEl = self.create_dependent_annotation(curPartsID, curGrammID, '', parts)
                     glossEl = self.create_dependent_annotation(curGlossID, curPartsID, '', gloss)
                     prevGrammID = curGrammID
-                    grammTier.insert(-1, grammEl)
-                    partsTier.insert(-1, partsEl)
-                    glossTier.insert(-1, glossEl)
-                    for addGrammTier in addGrammTiers:
+                    grammEls.append(grammEl)
+                    partsEls.append(partsEl)
+                    glossEls.append(glossEl)
+                    for addGrammTier, addGrammTierEls in addGrammEls.items():
                         if addGrammTier in ana:
-                            curAddID = 'a' + str(self.lastID)
-                            self.lastID += 1
+                            curAddID = 'a' + str(lastID)
+                            lastID += 1
                             value = ana[addGrammTier]
                             if type(value) == list:
                                 value = '/'.join(value)
                             addEl = self.create_dependent_annotation(curAddID, curGrammID, '', value)
-                            addGrammTiers[addGrammTier].insert(-1, addEl)
+                            addGrammTierEls.append(addEl)
+        self.lastID = lastID
         return nTokens, nWords, nAnalyzed
 
-    def process_tier(self, tierNode, participant, analyzedSegments):
+    def find_analyzed_segment(self, analyzedSegments, segStarts, segText, startTime):
+        """
+        Find an analyzed segment with the given normalized text
+        that starts within 0.1 s of startTime. analyzedSegments
+        are sorted by start time, segStarts are their start times.
+        Return None if there is no such segment.
+        """
+        minTime = startTime - 0.1
+        maxTime = startTime + 0.1
+        iSeg = bisect.bisect_left(segStarts, minTime)
+        while iSeg < len(segStarts) and segStarts[iSeg] <= maxTime:
+            if analyzedSegments[iSeg].textNorm == segText:
+                return analyzedSegments[iSeg]
+            iSeg += 1
+        return None
+
+    def process_tier(self, tierNode, participant, analyzedSegments, segStarts):
         """
         Add tokenization and analyses to one transcription tier.
         """
         nTokens = 0
         nWords = 0
         nAnalyzed = 0
-        iCurAnaSegment = 0
         tierID = tierNode.attrib['TIER_ID']
         wordTier, lemmaTier, grammTier, partsTier, glossTier, addLexTiers, addGrammTiers = self.get_analysis_tiers(tierNode, participant)
-
-        for segNode in tierNode.xpath('ANNOTATION/ALIGNABLE_ANNOTATION'):
-            if iCurAnaSegment >= len(analyzedSegments):
-                continue
+        wordEls = []
+        lemmaEls = []
+        grammEls = []
+        partsEls = []
+        glossEls = []
+        addLexEls = {addLexTierName: [] for addLexTierName in addLexTiers}
+        addGrammEls = {addGrammTierName: [] for addGrammTierName in addGrammTiers}
+
+        for segNode in tierNode.iter('ALIGNABLE_ANNOTATION'):
             if 'ANNOTATION_ID' not in segNode.attrib:
                 continue
             aID = segNode.attrib['ANNOTATION_ID']
             try:
-                segText = segNode.xpath('ANNOTATION_VALUE')[0].text.strip().lower()
+                segText = segNode.find('ANNOTATION_VALUE').text.strip().lower()
             except AttributeError:
                 continue
             tli1 = segNode.attrib['TIME_SLOT_REF1']
-            startTime = self.tlis[tli1]['time']
-            while not (analyzedSegments[iCurAnaSegment]['text'].strip().lower() == segText
-                       and startTime - 0.1 <= analyzedSegments[iCurAnaSegment]['start_time'] <= startTime + 0.1):
-                iCurAnaSegment += 1
-                if iCurAnaSegment >= len(analyzedSegments):
-                    break
-            if iCurAnaSegment >= len(analyzedSegments):
+            startTime = self.tlisTime[tli1]
+            curAna = self.find_analyzed_segment(analyzedSegments, segStarts,
+                                                segText, startTime)
+            if curAna is None:
                 continue
-            words = analyzedSegments[iCurAnaSegment]['words']
+            words = curAna.words
             curNTokens, curNWords, curNAnalyzed =\
                 self.process_segment(aID, words,
-                                     wordTier, lemmaTier, grammTier, partsTier, glossTier,
-                                     addLexTiers, addGrammTiers)
+                                     wordEls, lemmaEls, grammEls, partsEls, glossEls,
+                                     addLexEls, addGrammEls)
             nTokens += curNTokens
             nWords += curNWords
             nAnalyzed += curNAnalyzed
 
+        newEls = [(wordTier, wordEls), (lemmaTier, lemmaEls), (grammTier, grammEls),
+                  (partsTier, partsEls), (glossTier, glossEls)]
+        newEls += [(addLexTiers[tierType], addLexEls[tierType]) for tierType in addLexTiers]
+        newEls += [(addGrammTiers[tierType], addGrammEls[tierType]) for tierType in addGrammTiers]
+        for analysisTier, els in newEls:
+            analysisTier.extend(els)
+            # Annotations are built as elements without whitespace,
+            # so lay them out the way ELAN does
+            etree.indent(analysisTier, space='\t', level=1)
         return nTokens, nWords, nAnalyzed
 
+    def create_tier(self, tierType, parentID, participant, tierID):
+        """
+        Create an XML element representing an empty dependent tier.
+        """
+        return etree.Element('TIER', LINGUISTIC_TYPE_REF=tierType, PARENT_REF=parentID,
+                             PARTICIPANT=participant, TIER_ID=tierID)
+
+    def create_tier_type(self, constraint, tierType):
+        """
+        Create an XML element representing a tier type for
+        symbolic (not time-aligned) tiers.
+        """
+        return etree.Element('LINGUISTIC_TYPE', CONSTRAINTS=constraint,
+                             GRAPHIC_REFERENCES='false', LINGUISTIC_TYPE_ID=tierType,
+                             TIME_ALIGNABLE='false')
+
     def get_analysis_tiers(self, tierNode, participant):
         """
         Check if empty analysis tiers are already present for
@@ -346,78 +511,62 @@ class EafProcessor:
         tierID = tierNode.attrib['TIER_ID']
         tierParent = tierNode.getparent()
 
-        wordTiers = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.wordType + '\''
-                                       ' and @PARENT_REF=\'' + tierID + '\']')
-        if len(wordTiers) <= 0:
-            wordTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + self.wordType +\
-                          '" PARENT_REF="' + tierID + '" PARTICIPANT="' + participant +\
-                          '" TIER_ID="Words@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(tierNode) + 1, etree.XML(wordTierTxt))
-        wordTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.wordType + '\''
-                                      ' and @PARENT_REF=\'' + tierID + '\']')[0]
+        wordTiers = EafProcessor.xpChildTier(tierParent, tierType=self.wordType, parentID=tierID)
+        if len(wordTiers) > 0:
+            wordTier = wordTiers[0]
+        else:
+            wordTier = self.create_tier(self.wordType, tierID, participant,
+                                        'Words@' + participant)
+            self.insert_after(tierNode, wordTier)
         wordTierID = wordTier.attrib['TIER_ID']
 
-        lemmaTiers = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.lemmaType + '\''
-                                        ' and @PARENT_REF=\'' + wordTierID + '\']')
-        if len(lemmaTiers) <= 0:
-            lemmaTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + self.lemmaType + \
-                           '" PARENT_REF="' + wordTierID + '" PARTICIPANT="' + participant + \
-                           '" TIER_ID="Lemma@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(wordTier) + 1, etree.XML(lemmaTierTxt))
-        lemmaTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.lemmaType + '\''
-                                       ' and @PARENT_REF=\'' + wordTierID + '\']')[0]
+        lemmaTiers = EafProcessor.xpChildTier(tierParent, tierType=self.lemmaType, parentID=wordTierID)
+        if len(lemmaTiers) > 0:
+            lemmaTier = lemmaTiers[0]
+        else:
+            lemmaTier = self.create_tier(self.lemmaType, wordTierID, participant,
+                                         'Lemma@' + participant)
+            self.insert_after(wordTier, lemmaTier)
         lemmaTierID = lemmaTier.attrib['TIER_ID']
 
         addLexTiers = {}    # tier type -> tier node
-        for addLexTierName in sorted(self.addLexTiers, reverse=True):
-            addTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + addLexTierName + \
-                         '" PARENT_REF="' + lemmaTierID + '" PARTICIPANT="' + participant + \
-                         '" TIER_ID="' + addLexTierName + '@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(lemmaTier) + 1, etree.XML(addTierTxt))
-            addLexTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + addLexTierName + '\''
-                                            ' and @PARENT_REF=\'' + lemmaTierID + '\']')[0]
+        for addLexTierName in self.addLexTiersSorted:
+            addLexTier = self.create_tier(addLexTierName, lemmaTierID, participant,
+                                          addLexTierName + '@' + participant)
+            self.insert_after(lemmaTier, addLexTier)
             addLexTiers[addLexTierName] = addLexTier
 
-        grammTiers = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.grammType + '\''
-                                        ' and @PARENT_REF=\'' + lemmaTierID + '\']')
-        if len(grammTiers) <= 0:
-            grammTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + self.grammType + \
-                           '" PARENT_REF="' + lemmaTierID + '" PARTICIPANT="' + participant + \
-                           '" TIER_ID="Gramm@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(lemmaTier) + 1, etree.XML(grammTierTxt))
-        grammTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.grammType + '\''
-                                       ' and @PARENT_REF=\'' + lemmaTierID + '\']')[0]
+        grammTiers = EafProcessor.xpChildTier(tierParent, tierType=self.grammType, parentID=lemmaTierID)
+        if len(grammTiers) > 0:
+            grammTier = grammTiers[0]
+        else:
+            grammTier = self.create_tier(self.grammType, lemmaTierID, participant,
+                                         'Gramm@' + participant)
+            self.insert_after(lemmaTier, grammTier)
         grammTierID = grammTier.attrib['TIER_ID']
 
-        partsTiers = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.partsType + '\''
-                                        ' and @PARENT_REF=\'' + grammTierID + '\']')
-        if len(partsTiers) <= 0:
-            partsTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + self.partsType + \
-                           '" PARENT_REF="' + grammTierID + '" PARTICIPANT="' + participant + \
-                           '" TIER_ID="Morph@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(grammTier) + 1, etree.XML(partsTierTxt))
-        partsTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.partsType + '\''
-                                       ' and @PARENT_REF=\'' + grammTierID + '\']')[0]
+        partsTiers = EafProcessor.xpChildTier(tierParent, tierType=self.partsType, parentID=grammTierID)
+        if len(partsTiers) > 0:
+            partsTier = partsTiers[0]
+        else:
+            partsTier = self.create_tier(self.partsType, grammTierID, participant,
+                                         'Morph@' + participant)
+            self.insert_after(grammTier, partsTier)
         partsTierID = partsTier.attrib['TIER_ID']
 
-        glossTiers = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.glossType + '\''
-                                        ' and @PARENT_REF=\'' + partsTierID + '\']')
-        if len(glossTiers) <= 0:
-            glossTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + self.glossType + \
-                           '" PARENT_REF="' + partsTierID + '" PARTICIPANT="' + participant + \
-                           '" TIER_ID="Gloss@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(partsTier) + 1, etree.XML(glossTierTxt))
-        glossTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + self.glossType + '\''
-                                       ' and @PARENT_REF=\'' + partsTierID + '\']')[0]
+        glossTiers = EafProcessor.xpChildTier(tierParent, tierType=self.glossType, parentID=partsTierID)
+        if len(glossTiers) > 0:
+            glossTier = glossTiers[0]
+        else:
+            glossTier = self.create_tier(self.glossType, partsTierID, participant,
+                                         'Gloss@' + participant)
+            self.insert_after(partsTier, glossTier)
 
         addGrammTiers = {}  # tier type -> tier node
-        for addGrammTierName in sorted(self.addGrammTiers, reverse=True):
-            addTierTxt = '<TIER LINGUISTIC_TYPE_REF="' + addGrammTierName + \
-                         '" PARENT_REF="' + grammTierID + '" PARTICIPANT="' + participant + \
-                         '" TIER_ID="' + addGrammTierName + '@' + participant + '"/>\n'
-            tierParent.insert(tierParent.index(grammTier) + 1, etree.XML(addTierTxt))
-            addGrammTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + addGrammTierName + '\''
-                                              ' and @PARENT_REF=\'' + grammTierID + '\']')[0]
+        for addGrammTierName in self.addGrammTiersSorted:
+            addGrammTier = self.create_tier(addGrammTierName, grammTierID, participant,
+                                            addGrammTierName + '@' + participant)
+            self.insert_after(grammTier, addGrammTier)
             addGrammTiers[addGrammTierName] = addGrammTier
 
         return wordTier, lemmaTier, grammTier, partsTier, glossTier, addLexTiers, addGrammTiers
@@ -439,14 +588,10 @@ class EafProcessor:
         for addGrammTier in self.addGrammTiers:
             tierAttrs.append(('Symbolic_Association', addGrammTier))
         for constraint, tierType in tierAttrs:
-            tierTypeTxt = '<LINGUISTIC_TYPE CONSTRAINTS="' + constraint + '"' \
-                          ' GRAPHIC_REFERENCES="false" LINGUISTIC_TYPE_ID="' + tierType + '"' \
-                          ' TIME_ALIGNABLE="false"/>\n'
-            tierEl = self.eafTree.xpath('/ANNOTATION_DOCUMENT/LINGUISTIC_TYPE[@LINGUISTIC_TYPE_ID=\'' + tierType + '\']')
-            lastTier = self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER')[-1]
-            tierParent = lastTier.getparent()
+            tierEl = EafProcessor.xpTierType(self.eafTree, tierType=tierType)
+            lastTier = EafProcessor.xpTiers(self.eafTree)[-1]
             if len(tierEl) <= 0:
-                tierParent.insert(tierParent.index(lastTier) + 1, etree.XML(tierTypeTxt))
+                self.insert_after(lastTier, self.create_tier_type(constraint, tierType))
 
     def collectCSData(self):
         """
@@ -457,17 +602,18 @@ class EafProcessor:
         if self.csTier is None or len(self.csTier) <= 0:
             return
         self.csTranscriptionSegments = []
-        for tierNode in self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER'):
-            if 'TIER_ID' not in tierNode.attrib:
+        for tierNode in self.eafTree.getroot().iter('TIER'):
+            tierID = tierNode.get('TIER_ID')
+            if tierID is None:
                 continue
-            tierID = tierNode.attrib['TIER_ID']
+            tierType = tierNode.get('LINGUISTIC_TYPE_REF', '')
             if (self.rxCSTier.search(tierID) is not None
-                    or self.rxCSTier.search(tierNode.attrib['LINGUISTIC_TYPE_REF']) is not None):
-                for segNode in tierNode.xpath('ANNOTATION/REF_ANNOTATION'):
+                    or (len(tierType) > 0 and self.rxCSTier.search(tierType) is not None)):
+                for segNode in tierNode.iter('REF_ANNOTATION'):
                     if 'ANNOTATION_REF' not in segNode.attrib:
                         continue
                     try:
-                        segText = segNode.xpath('ANNOTATION_VALUE')[0].text.strip().lower()
+                        segText = segNode.find('ANNOTATION_VALUE').text.strip().lower()
                     except AttributeError:
                         continue
                     if self.csTurnOffRegex.search(segText) is not None:
@@ -475,37 +621,81 @@ class EafProcessor:
 
     def add_analyses(self):
         """
-        Add analyses from self.jsonDoc to self.eafTree.
+        Add analyses from self.jsonSentences to self.eafTree.
         """
         nTokens = 0
         nWords = 0
         nAnalyzed = 0
-        analyzedSegments = self.collect_analyzed_segments()
-        self.tlis = self.get_tlis(self.eafTree)
+        analyzedSegments = self.collect_analyzed_segments(self.jsonSentences)
+        segStarts = [seg.startTime for seg in analyzedSegments]
+        self.tlisTime = self.get_tlis(self.eafTree)
         self.check_tier_types()
         participantID = 1
         self.collectCSData()
-        for tierNode in self.eafTree.xpath('/ANNOTATION_DOCUMENT/TIER'):
-            if 'TIER_ID' not in tierNode.attrib:
+        # New tiers are inserted while transcription tiers are
+        # processed, so iterate over a list rather than the live tree.
+        for tierNode in list(self.eafTree.getroot().iter('TIER')):
+            tierID = tierNode.get('TIER_ID')
+            if tierID is None:
                 continue
-            tierID = tierNode.attrib['TIER_ID']
+            tierType = tierNode.get('LINGUISTIC_TYPE_REF', '')
             if (self.rxTiers.search(tierID) is not None
-                    or self.rxTiers.search(tierNode.attrib['LINGUISTIC_TYPE_REF']) is not None):
-                if 'PARTICIPANT' not in tierNode.attrib:
-                    participant = ''
-                else:
-                    participant = tierNode.attrib['PARTICIPANT']
+                    or (len(tierType) > 0 and self.rxTiers.search(tierType) is not None)):
+                participant = tierNode.get('PARTICIPANT', '')
                 if len(participant) <= 0:
                     participant = 'SP' + str(participantID)
                     participantID += 1
-                curTokens, curWords, curAnalyzed = self.process_tier(tierNode, participant, analyzedSegments)
+                curTokens, curWords, curAnalyzed = self.process_tier(tierNode, participant,
+                                                                    analyzedSegments, segStarts)
                 nTokens += curTokens
                 nWords += curWords
                 nAnalyzed += curAnalyzed
-        self.eafTree.xpath('/ANNOTATION_DOCUMENT/HEADER/'
-                           'PROPERTY[@NAME=\'lastUsedAnnotationId\']')[0].text = str(self.lastID - 1)
+        self.lastIDProp.text = str(self.lastID - 1)
+        return nTokens, nWords, nAnalyzed
+
+    def process_file(self, fnameEaf, fnameJson, fnameEafOut):
+        """
+        Add analyses from one JSON file to one ELAN file and write
+        the result. Return the numbers of tokens, words and analyzed
+        words, or None if the JSON file is empty.
+        """
+        self.eafTree = etree.parse(fnameEaf)
+        sentences = self.iter_json_sentences(fnameJson)
+        firstSentence = next(sentences, None)
+        if firstSentence is None:
+            print('JSON for ' + fnameEaf + ' is empty.')
+            return None
+        self.jsonSentences = itertools.chain([firstSentence], sentences)
+        self.lastIDProp = self.eafTree.getroot().find('HEADER/PROPERTY[@NAME="lastUsedAnnotationId"]')
+        self.lastID = int(self.lastIDProp.text) + 1
+        nTokens, nWords, nAnalyzed = self.add_analyses()
+        self.write_analyses(fnameEafOut)
         return nTokens, nWords, nAnalyzed
 
+    def get_worker_args(self):
+        """
+        Return constructor arguments for creating processors in worker
+        processes. They are taken from the current attributes, so that
+        changes made after construction are not lost.
+        """
+        csTier = None
+        csTurnOffRegex = ''
+        if self.csTier is not None and len(self.csTier) > 0:
+            csTier = self.csTier
+            csTurnOffRegex = self.csTurnOffRegex.pattern
+        return {
+            'tiers': self.tiers, 'lang': self.lang,
+            'wordType': self.wordType, 'lemmaType': self.lemmaType,
+            'grammType': self.grammType, 'partsType': self.partsType,
+            'glossType': self.glossType,
+            'lexTiers': self.addLexTiers,
+            'grammTiers': self.addGrammTiers,
+            'csTier': csTier,
+            'csTurnOffRegex': csTurnOffRegex,
+            'streamJson': self.streamJson,
+            'settings': self.settings
+        }
+
     def process_corpus(self):
         if not os.path.exists('eaf'):
             print('All ELAN files should be located in the eaf folder.')
@@ -521,34 +711,41 @@ class EafProcessor:
         nAnalyzed = 0
         nDocs = 0
 
-        for root, dirs, files in os.walk('eaf'):
+        eafRoot = pathlib.Path('eaf')
+        jsonRoot = pathlib.Path('json')
+        outRoot = pathlib.Path('eaf_analyzed')
+        fnamesEaf = []
+        fnamesJson = []
+        fnamesEafOut = []
+        for root, dirs, files in os.walk(eafRoot):
             for fname in files:
                 if not fname.lower().endswith('.eaf'):
                     continue
-                fnameEaf = os.path.join(root, fname)
-                fnameJson = 'json' + fnameEaf[3:len(fnameEaf)-3] + 'json'
-                fnameEafOut = 'eaf_analyzed' + fnameEaf[3:]
-                if not os.path.exists(fnameJson):
-                    print('No JSON found for ' + fnameEaf + '.')
+                fnameEaf = pathlib.Path(root, fname)
+                relPath = fnameEaf.relative_to(eafRoot)
+                fnameJson = jsonRoot / relPath.with_suffix('.json')
+                fnameEafOut = outRoot / relPath
+                if not fnameJson.exists():
+                    print('No JSON found for ' + str(fnameEaf) + '.')
                     continue
-                self.eafTree = etree.parse(fnameEaf)
-                with open(fnameJson, 'r', encoding='utf-8') as fJson:
-                    self.jsonDoc = json.load(fJson)
-                if (len(self.jsonDoc) <= 0 or 'sentences' not in self.jsonDoc
-                        or len(self.jsonDoc['sentences']) <= 0):
-                    print('JSON for ' + fnameEaf + ' is empty.')
+                # Create output folders here rather than in the workers
+                # to avoid races between them
+                fnameEafOut.parent.mkdir(parents=True, exist_ok=True)
+                fnamesEaf.append(str(fnameEaf))
+                fnamesJson.append(str(fnameJson))
+                fnamesEafOut.append(str(fnameEafOut))
+
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for counts in executor.map(process_one,
+                                       [self.get_worker_args()] * len(fnamesEaf),
+                                       fnamesEaf, fnamesJson, fnamesEafOut):
+                if counts is None:
                     continue
-                outDirName = EafProcessor.rxDir.sub('', fnameEafOut)
-                if len(outDirName) > 0 and not os.path.exists(outDirName):
-                    os.makedirs(outDirName)
+                curTokens, curWords, curAnalyzed = counts
                 nDocs += 1
-                self.lastID = int(self.eafTree.xpath('/ANNOTATION_DOCUMENT/HEADER/'
-                                                     'PROPERTY[@NAME=\'lastUsedAnnotationId\']')[0].text) + 1
-                curTokens, curWords, curAnalyzed = self.add_analyses()
                 nTokens += curTokens
                 nWords += curWords
                 nAnalyzed += curAnalyzed
-                self.write_analyses(fnameEafOut)
         if nWords == 0:
             percentAnalyzed = 0
         else:
@@ -558,6 +755,16 @@ class EafProcessor:
               + str(nAnalyzed) + ' analyzed (' + str(percentAnalyzed) + '%).')
 
 
+def process_one(epArgs, fnameEaf, fnameJson, fnameEafOut):
+    """
+    Process one ELAN file with a fresh EafProcessor created from
+    the constructor arguments in epArgs. This is a module-level
+    function so that files can be dispatched to worker processes.
+    """
+    ep = EafProcessor(**epArgs)
+    return ep.process_file(fnameEaf, fnameJson, fnameEafOut)
+
+
 if __name__ == '__main__':
     ep = EafProcessor('.*_Transcription-txt-.*', lang='meadow_mari',
                       grammTiers=['trans_ru', 'lex2', 'trans_ru2'],